@@ -1,7 +1,12 @@
+import hashlib
 import re
+import sys
+from collections import OrderedDict
+from threading import Lock
 from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import Optional
+from fastapi.concurrency import run_in_threadpool
+from pydantic import BaseModel, ConfigDict
+from typing import Any, Dict, Hashable, Optional, Tuple
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -14,73 +19,261 @@ class Input(BaseModel):
     query: Optional[str] = None  # The procedure code (e.g., MEXIP01) or an error description
 
 class Output(BaseModel):
-    """The output structure for the API's response."""
+    """The output structure for the API's response (immutable, as cached responses are shared)."""
+    model_config = ConfigDict(frozen=True)
     procedure: Optional[str] = None  # The found procedure code
     steps: Optional[str] = None      # The raw text block of the procedure steps
     message: str                     # A descriptive message about the result
 
+# --- Precompiled Regular Expressions ---
+
+# A procedure code (3+ uppercase letters, then 2+ digits) starting a line, after
+# optional indentation. The indentation class excludes newlines, so each attempt
+# stays within its own line and scanning a document is linear. The literal newline
+# prefix lets the engine skip straight from line to line instead of attempting a
+# match at every character (as a MULTILINE `^` would); the first line of a document
+# is checked separately.
+_CODE_HEADER_RE = re.compile(r'\n[^\S\n]*([A-Z]{3,}[0-9]{2,})')
+_FIRST_LINE_CODE_RE = re.compile(r'[^\S\n]*([A-Z]{3,}[0-9]{2,})')
+
+# --- Error Description Mapping ---
+
+# Maps common error descriptions to known procedure codes, checked in order.
+# Keywords are lowercase and matched as plain substrings of the lowercased query.
+_ERROR_KEYWORDS = (
+    (("invalid", "not supported"), "MEXIP01"),
+    (("not detected", "missing"), "MEXIP02"),
+    (("power problem", "power issue"), "MEXIP03"),
+    # Add more mappings as needed
+)
+
 # --- Helper Function for Text Normalization ---
 
+# Substrings that never occur in normalized ASCII text: runs of spaces, spaces around
+# line breaks, blank lines, and ASCII whitespace other than space/newline.
+# Most common in PDF extractions first, so unnormalized text is rejected early.
+_UNNORMALIZED_MARKERS = ('  ', '\n\n', ' \n', '\n ', '\t', '\r', '\x0b', '\x0c', '\x1c', '\x1d', '\x1e', '\x1f')
+
+def _is_normalized(text: str) -> bool:
+    """
+    Cheaply checks whether text is already in the form produced by
+    _normalize_text_for_parsing (e.g. when it was normalized by an upstream service).
+    Only ASCII text is considered; isascii() is O(1) on str.
+    """
+    return (
+        text.isascii()
+        and text == text.strip()
+        and not any(marker in text for marker in _UNNORMALIZED_MARKERS)
+    )
+
 def _normalize_text_for_parsing(text: str) -> str:
     """
     Normalizes text to handle common PDF extraction issues while preserving line structure:
     - Replaces various unicode whitespace characters with standard space.
     - Replaces multiple spaces within a line with a single space.
     - Strips leading/trailing whitespace from each line.
-    - Consolidates multiple blank lines into a single blank line.
-    """
-    lines = text.split('\n')
-    cleaned_lines = []
-    for line in lines:
-        # Replace unicode spaces and multiple spaces with a single space within the line
-        line = re.sub(r'[\u00A0\u200B\u2003\u2009\s]+', ' ', line).strip()
-        if line: # Only add non-empty lines
-            cleaned_lines.append(line)
-    
-    # Join lines and then consolidate multiple blank lines
-    cleaned_text = '\n'.join(cleaned_lines)
-    cleaned_text = re.sub(r'\n{2,}', '\n\n', cleaned_text) # Consolidate 2 or more newlines into two
-    return cleaned_text.strip()
+    - Drops blank lines.
+    """
+    # Text that is already normalized is returned as-is (the caller's own string object),
+    # skipping the per-line work
+    if _is_normalized(text):
+        return text
+    # The zero-width space is not whitespace to str.split(), so map it to a regular space first
+    lines = text.replace('\u200B', ' ').split('\n')
+    # str.split() with no separator splits on runs of unicode whitespace (the same set as
+    # regex \s) and drops leading/trailing ones, so re-joining with single spaces collapses
+    # and strips each line without going through the regex engine.
+    cleaned_lines = [' '.join(line.split()) for line in lines]
+    # Only keep non-empty lines
+    return '\n'.join(line for line in cleaned_lines if line)
 
 # --- Core Logic for Finding Procedure Steps ---
 
 def find_procedure_steps(text: str, procedure_code: str) -> Optional[str]:
     """
     Finds the raw text block for a given procedure code.
-    The regex captures everything from the procedure code up to the next
+    The block runs from the procedure code up to the next
     procedure code or the end of the document.
     """
     procedure_code = procedure_code.strip().upper()
-    escaped_code = re.escape(procedure_code)
-
-    # More flexible pattern to capture the entire block for a procedure code
-    # It looks for the procedure code, then non-greedily captures any characters (including newlines)
-    # until it finds the start of another procedure code (e.g., MEXIP02, MEXIP03) or the end of the text.
-    # The next code pattern is flexible: starts with 3+ uppercase letters, then 2+ digits, on a new line.
-    pattern = re.compile(
-        rf"({escaped_code}\s*.*?)(?=\n\s*[A-Z]{{3,}}[0-9]{{2,}}|\Z)",
-        re.DOTALL
+
+    # Locate the code with a plain substring search, then search forward once for the
+    # start of another procedure code (e.g., MEXIP02, MEXIP03) rather than probing a
+    # lookahead after every character of the block.
+    start = text.find(procedure_code)
+    if start == -1:
+        return None
+    next_code = _CODE_HEADER_RE.search(text, start + len(procedure_code))
+    end = next_code.start() if next_code else len(text)
+    return text[start:end].strip()
+
+def _index_document(text: str) -> Dict[str, slice]:
+    """
+    Indexes a normalized document in a single pass, mapping each procedure code
+    that starts a line to the slice of the text holding its block (up to the next
+    such code). Blocks are only cut out of the text when a procedure is actually requested.
+    """
+    blocks = {}
+    # Walk the headers once, keeping only the previous header's code and start, so no
+    # per-header match objects are held while the index is built.
+    code, start = None, 0
+    first_line_header = _FIRST_LINE_CODE_RE.match(text)
+    if first_line_header:
+        code, start = first_line_header.group(1), first_line_header.start(1)
+    for header in _CODE_HEADER_RE.finditer(text):
+        if code is not None:
+            # The first block for a code wins, as with find_procedure_steps
+            blocks.setdefault(code, slice(start, header.start()))
+        code, start = header.group(1), header.start(1)
+    if code is not None:
+        blocks.setdefault(code, slice(start, len(text)))
+    return blocks
+
+def _lookup_procedure(normalized_text: str, blocks: Dict[str, slice], procedure_code: str) -> Output:
+    """
+    Looks up a procedure code in an indexed document and builds the response for it.
+    """
+    # Codes that don't start a line, such as ones only mentioned inline, fall back to a full scan
+    block = blocks.get(procedure_code)
+    if block is not None:
+        result_steps_text = normalized_text[block].strip()
+    else:
+        result_steps_text = find_procedure_steps(normalized_text, procedure_code)
+
+    if result_steps_text:
+        # Optionally, you could try to extract a brief description from the result_steps_text
+        # For this simplified version, we'll just return the full block.
+        return Output(
+            procedure=procedure_code,
+            steps=result_steps_text,
+            message=f"Procedure '{procedure_code}' found. Full text of steps provided."
+        )
+    else:
+        return Output(
+            procedure=procedure_code,
+            steps=None,
+            message=f"Procedure '{procedure_code}' not found in the provided text."
+        )
+
+# --- Document and Response Caches ---
+
+class _LRUCache:
+    """
+    A small least-recently-used cache, bounded both by its number of entries and by
+    the approximate memory (in bytes) of the values it holds. Thread-safe, as searches
+    run in the threadpool.
+    """
+
+    def __init__(self, maxsize: int, maxbytes: int):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self._entries: "OrderedDict[Hashable, Tuple[Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = Lock()
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Returns the cached value for a key (or None), marking it as recently used.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, key: Hashable, value: Any, nbytes: int) -> None:
+        """
+        Stores a value of the given size, evicting the least recently used ones while
+        the cache is over either bound. Values larger than the whole budget are not cached.
+        """
+        if nbytes > self.maxbytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (value, nbytes)
+            self._bytes += nbytes
+            while len(self._entries) > self.maxsize or self._bytes > self.maxbytes:
+                _, (_, evicted_bytes) = self._entries.popitem(last=False)
+                self._bytes -= evicted_bytes
+
+# Both caches are keyed by a digest of the posted text, but their values do retain
+# document data: each document entry holds the full normalized text plus its block
+# index (a dict entry, code string and slice per header line, which on header-heavy
+# text outweighs the text itself), and each response holds a procedure block. Entries
+# are charged their measured size, so the caches hold at most about 64 MB of documents
+# and 16 MB of responses; larger documents are searched but not cached.
+# Document digest -> (normalized text, index of its procedure blocks)
+_document_cache = _LRUCache(maxsize=32, maxbytes=64_000_000)
+# (document digest, procedure code) -> response
+_response_cache = _LRUCache(maxsize=256, maxbytes=16_000_000)
+
+def _document_size(normalized_text: str, blocks: Dict[str, slice]) -> int:
+    """
+    Returns the approximate memory, in bytes, held by a cached document: its text and
+    its index (the dict plus each code, slice and slice offsets).
+    """
+    getsizeof = sys.getsizeof
+    return getsizeof(normalized_text) + getsizeof(blocks) + sum(
+        getsizeof(code) + getsizeof(block) + getsizeof(block.start) + getsizeof(block.stop)
+        for code, block in blocks.items()
     )
-    
-    match = pattern.search(text)
-    if match:
-        return match.group(1).strip()
-    return None
+
+def _digest_text(text: str) -> bytes:
+    """
+    Returns a compact digest identifying a document's text.
+    """
+    # surrogatepass: JSON bodies may carry lone surrogates, which strict UTF-8 rejects
+    return hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+
+def _load_document(digest: bytes, text: str) -> Tuple[str, Dict[str, slice]]:
+    """
+    Returns the normalized text of a document and its procedure index, normalizing
+    and indexing it only the first time it is seen.
+    """
+    document = _document_cache.get(digest)
+    if document is None:
+        # Normalize the input text before processing to handle PDF extraction quirks
+        normalized_text = _normalize_text_for_parsing(text)
+        blocks = _index_document(normalized_text)
+        document = (normalized_text, blocks)
+        # For already-normalized input, normalized_text is the posted string itself, so
+        # caching it keeps the posted body alive; either way it counts in full against the
+        # cache's memory budget, which (not the digest key) is what bounds memory.
+        _document_cache.put(digest, document, _document_size(normalized_text, blocks))
+    return document
+
+def _search_procedure(text: str, procedure_code: str) -> Output:
+    """
+    Returns the response for a procedure code, served from the cache when the same
+    document was already searched for it. CPU-bound; run off the event loop.
+    """
+    digest = _digest_text(text)
+    # The response only depends on the document and the code, so repeated
+    # lookups (even via differently worded queries) are served from the cache.
+    cache_key = (digest, procedure_code)
+    response = _response_cache.get(cache_key)
+    if response is None:
+        normalized_text, blocks = _load_document(digest, text)
+        response = _lookup_procedure(normalized_text, blocks, procedure_code)
+        _response_cache.put(cache_key, response, sys.getsizeof(response.steps) + sys.getsizeof(response.message))
+    return response
 
 # --- FastAPI Endpoint ---
 
 @app.post("/search-isolation-procedure", response_model=Output)
-def search_isolation_procedure(payload: Input):
+async def search_isolation_procedure(payload: Input):
     """
     Searches for an isolation procedure by code or inferred error description
     and returns its raw text steps.
+    Queries that can be answered without the document are handled directly on the
+    event loop; hashing and searching the document runs in the threadpool.
     """
     text = payload.text
     query = (payload.query or "").strip()
 
-    # Normalize the input text before processing to handle PDF extraction quirks
-    normalized_text = _normalize_text_for_parsing(text)
-
     if not query:
         return Output(
             procedure=None,
@@ -89,44 +282,24 @@ def search_isolation_procedure(payload: Input):
         )
 
     # --- Basic Inference Logic (added functionality) ---
-    # This maps common error descriptions to known procedure codes.
-    error_to_procedure_map = {
-        "invalid|not supported": "MEXIP01",
-        "not detected|missing": "MEXIP02",
-        "power problem|power issue": "MEXIP03",
-        # Add more mappings as needed
-    }
-    
     inferred_procedure_code = None
     # First, try to infer the procedure code from the query's keywords
-    for keywords, code in error_to_procedure_map.items():
-        if re.search(keywords, query, re.IGNORECASE):
+    query_lower = query.lower()
+    for keywords, code in _ERROR_KEYWORDS:
+        if any(keyword in query_lower for keyword in keywords):
             inferred_procedure_code = code
             break
-    
+
     # If no inference, check if the query itself is a procedure code
+    # (e.g., MEXIP01): a fixed prefix plus two digits needs no regex.
     if not inferred_procedure_code:
-        if re.match(r"MEXIP\d{2}", query, re.IGNORECASE):
-            inferred_procedure_code = query.upper()
+        query_upper = query.upper()
+        if len(query_upper) >= 7 and query_upper.startswith("MEXIP") and query_upper[5:7].isdecimal():
+            inferred_procedure_code = query_upper
     
     # --- Execute Search based on inferred or direct code ---
     if inferred_procedure_code:
-        result_steps_text = find_procedure_steps(normalized_text, inferred_procedure_code)
-        
-        if result_steps_text:
-            # Optionally, you could try to extract a brief description from the result_steps_text
-            # For this simplified version, we'll just return the full block.
-            return Output(
-                procedure=inferred_procedure_code,
-                steps=result_steps_text,
-                message=f"Procedure '{inferred_procedure_code}' found. Full text of steps provided."
-            )
-        else:
-            return Output(
-                procedure=inferred_procedure_code,
-                steps=None,
-                message=f"Procedure '{inferred_procedure_code}' not found in the provided text."
-            )
+        return await run_in_threadpool(_search_procedure, text, inferred_procedure_code)
     else:
         # If no procedure code could be inferred or directly matched from the query
         return Output(
@@ -0,0 +1,53 @@
+import asyncio
+
+import main
+from main import Input, find_procedure_steps, search_isolation_procedure
+
+def _search(text: str, query: str):
+    """Calls the endpoint function directly and returns its Output."""
+    return asyncio.run(search_isolation_procedure(Input(text=text, query=query)))
+
+# --- Block lookup by line header ---
+
+def test_header_block_wins_over_earlier_inline_mention():
+    # MEXIP02 is mentioned inside MEXIP01's steps before its own header line
+    text = (
+        "MEXIP01\n"
+        "1. Check the location code.\n"
+        "No: Use procedure MEXIP02.\n"
+        "MEXIP02\n"
+        "1. Reseat the device."
+    )
+    result = _search(text, "MEXIP02")
+    assert result.procedure == "MEXIP02"
+    assert result.steps == "MEXIP02\n1. Reseat the device."
+
+def test_code_does_not_match_longer_code_starting_with_it():
+    text = "MEXIP0123 unrelated block\nMEXIP01\n1. Record the location code."
+    result = _search(text, "MEXIP01")
+    assert result.steps == "MEXIP01\n1. Record the location code."
+
+def test_inline_only_code_falls_back_to_scan():
+    # A code that never starts a line is still found where it is mentioned
+    assert find_procedure_steps("MEXIP01\n1. See MEXIP03 first.\nMEXIP02 next", "MEXIP03") == "MEXIP03 first."
+
+def test_header_on_next_line_ends_the_block():
+    # A header directly after the code's line ends its (empty) block instead of being swallowed
+    text = "MEXIP01\nMEXIP02\n1. Reseat the device."
+    assert _search(text, "MEXIP01").steps == "MEXIP01"
+    assert find_procedure_steps("See MEXIP03\nMEXIP02\n1. Reseat the device.", "MEXIP03") == "MEXIP03"
+
+# --- Caching ---
+
+def test_repeated_lookup_is_served_from_cache(monkeypatch):
+    text = "MEXIP01\n1. Record the location code.\nMEXIP02\n1. Reseat the device.\n(cache test)"
+    first = _search(text, "invalid location code")
+
+    def fail(_text):
+        raise AssertionError("document was normalized again")
+    monkeypatch.setattr(main, "_normalize_text_for_parsing", fail)
+
+    # Same document and code (via a differently worded query) hits the response cache
+    assert _search(text, "MEXIP01") is first
+    # A different code on the same document reuses the cached normalized text and index
+    assert _search(text, "device missing").steps == "MEXIP02\n1. Reseat the device.\n(cache test)"